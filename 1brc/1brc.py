@@ -1,68 +1,508 @@
-import os, sys
+import math, os, stat, sys
 
-from rpython.rlib.rfloat import formatd
-from rpython.rlib.rmmap import mmap, ACCESS_READ, MADV_SEQUENTIAL
+from rpython.rlib import rposix
+from rpython.rlib.listsort import make_timsort_class
+from rpython.rlib.objectmodel import specialize
+from rpython.rlib.rarithmetic import (intmask, longlongmask, r_longlong,
+    r_uint, r_ulonglong)
+from rpython.rlib.rawstorage import raw_storage_getitem_unaligned
+from rpython.rlib.rmmap import (mmap, ACCESS_READ, ALLOCATIONGRANULARITY,
+    MADV_SEQUENTIAL)
+from rpython.rlib.rstring import StringBuilder
+from rpython.rtyper.lltypesystem import lltype, rffi
 
+# Temperatures are kept as integer tenths of a degree, so that totals are
+# exact and partial summaries can be merged without loss.
 class Summary(object):
     count = 1
 
-    def __init__(self, f): self.high = self.low = self.average = f
-
-    def observe(self, f):
-        count = self.count + 1
-        # Cut-down Welford's algorithm. Kahan summation is skipped because
-        # inputs are already truncated and output will be truncated too;
-        # empirical error is less than one part per million, so don't bother.
-        self.average += (f - self.average) / count
-        # ILP hacking: Write the average first for data dependencies, then the
-        # count, and then do the conditional writes last.
-        self.count = count
-        if f > self.high: self.high = f
-        elif f < self.low: self.low = f
-
-    def show(self):
-        return (formatd(self.low, 'f', 1) + "/" +
-                formatd(self.average, 'f', 1) + "/" +
-                formatd(self.high, 'f', 1))
-
-def collectLines(lines):
-    indices = {}
-    summaries = []
+    def __init__(self, t):
+        self.low = self.high = t
+        self.total = r_longlong(t)
+
+    def observe(self, t):
+        self.total += t
+        self.count += 1
+        if t > self.high: self.high = t
+        elif t < self.low: self.low = t
+
+    def merge(self, other):
+        self.total += other.total
+        self.count += other.count
+        if other.high > self.high: self.high = other.high
+        if other.low < self.low: self.low = other.low
+
+    def mean(self):
+        # Round half up, as the reference implementation does.
+        return intmask((2 * self.total + self.count) // (2 * self.count))
+
+    def show(self, builder):
+        appendTenths(builder, self.low)
+        builder.append('/')
+        appendTenths(builder, self.mean())
+        builder.append('/')
+        appendTenths(builder, self.high)
+
+def appendTenths(builder, t):
+    if t < 0:
+        builder.append('-')
+        t = -t
+    whole = t // 10
+    place = 1
+    while place * 10 <= whole: place *= 10
+    while place:
+        builder.append(chr(ord('0') + whole // place % 10))
+        place //= 10
+    builder.append('.')
+    builder.append(chr(ord('0') + t % 10))
+
+def parseTenths(s): return int(math.floor(float(s) * 10.0 + 0.5))
+
+# Fast path for the challenge's number format, -?d+.d, read in place from the
+# map. Anything else is MALFORMED and should go through parseTenths instead.
+MALFORMED = -sys.maxint - 1
+
+def scanTenths(data, pos, end):
+    if pos >= end: return MALFORMED
+    negative = data[pos] == '-'
+    if negative: pos += 1
+    if not 3 <= end - pos <= 6 or data[end - 2] != '.': return MALFORMED
+    t = 0
+    while pos < end - 2:
+        d = ord(data[pos]) - ord('0')
+        if not 0 <= d <= 9: return MALFORMED
+        t = t * 10 + d
+        pos += 1
+    d = ord(data[end - 1]) - ord('0')
+    if not 0 <= d <= 9: return MALFORMED
+    t = t * 10 + d
+    return -t if negative else t
+
+# Delimiters are found a machine word at a time (SWAR). Words are loaded in
+# native byte order, so "first byte in memory" depends on endianness.
+WORD = rffi.sizeof(lltype.Unsigned)
+BIG_ENDIAN = sys.byteorder == "big"
+ONES = r_uint(-1) // r_uint(0xff)
+LOWS = ONES * 0x7f
+SEMICOLONS = ONES * ord(';')
+NEWLINES = ONES * ord('\n')
+
+def loadWord(data, pos):
+    return raw_storage_getitem_unaligned(lltype.Unsigned, data, pos)
+
+# Pack the n <= WORD bytes at chars[pos:] into a word as a load would see them.
+@specialize.argtype(0)
+def packWord(chars, pos, n):
+    word = r_uint(0)
+    for i in range(n):
+        shift = 8 * (WORD - 1 - i) if BIG_ENDIAN else 8 * i
+        word |= r_uint(ord(chars[pos + i])) << shift
+    return word
+
+# Set the high bit of exactly those bytes of word which equal the byte
+# repeated in pattern, and clear every other bit.
+def findByte(word, pattern):
+    x = word ^ pattern
+    return ~(((x & LOWS) + LOWS) | x | LOWS)
+
+# Byte p of this constant is WORD - 1 - p; multiplying it by 1 << 8 * n moves
+# the byte holding n to the top of the word.
+BYTE_INDICES = r_uint(0)
+for _p in range(WORD): BYTE_INDICES |= r_uint(WORD - 1 - _p) << (8 * _p)
+
+def firstByte(hits):
+    if BIG_ENDIAN:
+        n = 0
+        while not hits >> (8 * WORD - 1):
+            hits <<= 8
+            n += 1
+        return n
+    lowest = hits & (~hits + 1)
+    return intmask(((lowest >> 7) * BYTE_INDICES) >> (8 * (WORD - 1)))
+
+# Keep the first n < WORD bytes of a word, in memory order.
+def prefixMask(n):
+    if BIG_ENDIAN: return ~(r_uint(-1) >> (8 * n))
+    return (r_uint(1) << (8 * n)) - 1
+
+# Station names are hashed a word at a time while they are scanned: every
+# whole word, and then the zero-padded remainder, even when it is empty.
+HASH_BASIS = intmask(2166136261)
+def hashWord(h, word):
+    h = intmask((h ^ intmask(word)) * intmask(0x9e3779b1))
+    return h ^ (h >> (4 * WORD))
+
+def hashName(name):
+    h = HASH_BASIS
     pos = 0
-    top = lines.size
+    while pos + WORD <= len(name):
+        h = hashWord(h, packWord(name, pos, WORD))
+        pos += WORD
+    return hashWord(h, packWord(name, pos, len(name) - pos))
+
+# Open-addressing table from station names to summaries. Lookups are keyed on
+# a hash and a span of raw bytes; a station's name is only copied out of the
+# buffer the first time that it is seen.
+class StationTable(object):
+    def __init__(self):
+        self.hashes = [0] * 1024
+        self.entries = [-1] * 1024
+        self.names = []
+        self.summaries = []
+
+    def observe(self, data, pos, length, h, t):
+        mask = len(self.entries) - 1
+        i = h & mask
+        while True:
+            entry = self.entries[i]
+            if entry < 0: break
+            if self.hashes[i] == h and self.matches(entry, data, pos, length):
+                self.summaries[entry].observe(t)
+                return
+            i = (i + 1) & mask
+        name = rffi.charpsize2str(rffi.ptradd(data, pos), length)
+        self.insert(i, h, name, Summary(t))
+
+    def matches(self, entry, data, pos, length):
+        name = self.names[entry]
+        if len(name) != length: return False
+        for i in range(length):
+            if name[i] != data[pos + i]: return False
+        return True
+
+    def merge(self, name, summary):
+        h = hashName(name)
+        mask = len(self.entries) - 1
+        i = h & mask
+        while True:
+            entry = self.entries[i]
+            if entry < 0: break
+            if self.hashes[i] == h and self.names[entry] == name:
+                self.summaries[entry].merge(summary)
+                return
+            i = (i + 1) & mask
+        self.insert(i, h, name, summary)
+
+    def mergeTable(self, other):
+        for i in range(len(other.names)):
+            self.merge(other.names[i], other.summaries[i])
+
+    def insert(self, i, h, name, summary):
+        self.hashes[i] = h
+        self.entries[i] = len(self.names)
+        self.names.append(name)
+        self.summaries.append(summary)
+        # Keep the load factor under one half.
+        if 2 * len(self.names) > len(self.entries): self.grow()
+
+    def grow(self):
+        size = 2 * len(self.entries)
+        mask = size - 1
+        hashes = [0] * size
+        entries = [-1] * size
+        for i in range(len(self.entries)):
+            entry = self.entries[i]
+            if entry < 0: continue
+            h = self.hashes[i]
+            j = h & mask
+            while entries[j] >= 0: j = (j + 1) & mask
+            hashes[j] = h
+            entries[j] = entry
+        self.hashes = hashes
+        self.entries = entries
+
+# Aggregate the rows in data[pos:top] into table. pos must be at the start of
+# a line. Returns the offset of the first row that was not consumed: a row
+# is incomplete without its ';', and also without its newline unless this is
+# the final range of the input. Whole words are only loaded from inside the
+# range; the last few bytes are examined one at a time.
+def collectLines(table, data, pos, top, final):
+    while pos < top:
+        h = HASH_BASIS
+        semi = pos
+        while True:
+            if semi + WORD > top:
+                n = 0
+                while semi + n < top and data[semi + n] != ';': n += 1
+                if semi + n >= top: return pos
+                h = hashWord(h, packWord(data, semi, n))
+                semi += n
+                break
+            word = loadWord(data, semi)
+            hits = findByte(word, SEMICOLONS)
+            if hits:
+                n = firstByte(hits)
+                h = hashWord(h, word & prefixMask(n))
+                semi += n
+                break
+            h = hashWord(h, word)
+            semi += WORD
+        nl = semi + 1
+        while True:
+            if nl + WORD > top:
+                while nl < top and data[nl] != '\n': nl += 1
+                break
+            hits = findByte(loadWord(data, nl), NEWLINES)
+            if hits:
+                nl += firstByte(hits)
+                break
+            nl += WORD
+        if nl >= top and not final: return pos
+        sample = scanTenths(data, semi + 1, nl)
+        if sample == MALFORMED:
+            number = rffi.charpsize2str(rffi.ptradd(data, semi + 1),
+                                        nl - semi - 1)
+            sample = parseTenths(number)
+        table.observe(data, pos, semi - pos, h, sample)
+        pos = nl + 1
+    return top
+
+# Streaming input, for pipes and other files which can't be mapped. Blocks
+# are read into a fixed raw buffer; a partial row at the end of a block is
+# moved to the front of the buffer before the next read.
+STREAM_BUFFER = 1 << 20
+
+def collectStream(fd):
+    table = StationTable()
+    buf = lltype.malloc(rffi.CCHARP.TO, STREAM_BUFFER, flavor='raw')
+    try:
+        filled = 0
+        while True:
+            got = readInto(fd, rffi.ptradd(buf, filled), STREAM_BUFFER - filled)
+            top = filled + got
+            pos = collectLines(table, buf, 0, top, not got)
+            if not got: return table
+            if not pos and top == STREAM_BUFFER:
+                raise ValueError("row longer than the stream buffer")
+            filled = top - pos
+            for i in range(filled): buf[i] = buf[pos + i]
+    finally: lltype.free(buf, flavor='raw')
+
+def readInto(fd, buf, size):
+    got = rffi.cast(lltype.Signed,
+                    rposix.c_read(fd, rffi.cast(rffi.VOIDP, buf), size))
+    if got < 0: raise OSError(rposix.get_saved_errno(), "read failed")
+    return got
+
+# Cut data[start:stop] into newline-aligned ranges, one per job.
+def splitRanges(data, start, stop, jobs):
+    bounds = [start]
+    for i in range(1, jobs):
+        pos = max(start + (stop - start) // jobs * i, bounds[-1])
+        while start < pos < stop and data[pos - 1] != '\n': pos += 1
+        bounds.append(pos)
+    bounds.append(stop)
+    return bounds
+
+# Tables are exchanged with workers, and saved in checkpoints, in a compact
+# little-endian binary form: a 4-byte station count, then for each station a
+# 2-byte name length, the name, an 8-byte count, an 8-byte total of tenths,
+# and 4-byte low and high.
+def packInt(builder, n, size):
+    n = r_longlong(n)
+    for i in range(size): builder.append(chr(intmask(n >> (8 * i)) & 0xff))
+
+class Unpacker(object):
+    def __init__(self, s):
+        self.s = s
+        self.pos = 0
+
+    def bytes(self, size):
+        pos = self.pos
+        if size < 0 or pos + size > len(self.s):
+            raise ValueError("truncated table")
+        self.pos = pos + size
+        return self.s[pos:pos + size]
+
+    def int(self, size):
+        chunk = self.bytes(size)
+        n = r_ulonglong(0)
+        for i in range(size): n |= r_ulonglong(ord(chunk[i])) << (8 * i)
+        # Sign-extend narrower fields.
+        if size < 8 and n >> (8 * size - 1): n -= r_ulonglong(1) << (8 * size)
+        return longlongmask(n)
+
+def dumpTable(builder, table):
+    packInt(builder, len(table.names), 4)
+    for i in range(len(table.names)):
+        name = table.names[i]
+        summary = table.summaries[i]
+        packInt(builder, len(name), 2)
+        builder.append(name)
+        packInt(builder, summary.count, 8)
+        packInt(builder, summary.total, 8)
+        packInt(builder, summary.low, 4)
+        packInt(builder, summary.high, 4)
+
+def loadTable(unpacker, table):
+    for _ in range(intmask(unpacker.int(4))):
+        name = unpacker.bytes(intmask(unpacker.int(2)) & 0xffff)
+        count = intmask(unpacker.int(8))
+        total = unpacker.int(8)
+        summary = Summary(intmask(unpacker.int(4)))
+        summary.high = intmask(unpacker.int(4))
+        summary.count = count
+        summary.total = total
+        table.merge(name, summary)
+
+# A checkpoint is a table together with the offset of the first byte of the
+# samples which it does not cover. Samples files are assumed to be
+# append-only; a file which has shrunk since is aggregated from scratch.
+CHECKPOINT_MAGIC = "1BRC\x01"
+
+def loadCheckpoint(path, table):
+    try: fd = os.open(path, os.O_RDONLY, 0)
+    except OSError: return 0
+    try: unpacker = Unpacker(readAll(fd))
+    finally: os.close(fd)
+    if unpacker.bytes(len(CHECKPOINT_MAGIC)) != CHECKPOINT_MAGIC:
+        raise ValueError("not a 1brc checkpoint")
+    offset = intmask(unpacker.int(8))
+    loadTable(unpacker, table)
+    return offset
+
+def saveCheckpoint(path, table, offset):
+    builder = StringBuilder()
+    builder.append(CHECKPOINT_MAGIC)
+    packInt(builder, offset, 8)
+    dumpTable(builder, table)
+    # Replace the old checkpoint atomically.
+    temp = path + ".tmp"
+    fd = os.open(temp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+    try: writeAll(fd, builder.build())
+    finally: os.close(fd)
+    os.rename(temp, path)
+
+NameSort = make_timsort_class(lt=lambda l, r: l[0] < r[0])
+
+# The challenge's output: {name=min/mean/max, ...}, sorted by name. UTF-8
+# byte order agrees with code point order, so names compare as bytes.
+def showTable(table):
+    stations = [(table.names[i], i) for i in range(len(table.names))]
+    NameSort(stations).sort()
+    size = 3
+    for name in table.names: size += len(name) + len("=-99.9/-99.9/-99.9, ")
+    builder = StringBuilder(size)
+    builder.append('{')
+    for j in range(len(stations)):
+        name, i = stations[j]
+        if j: builder.append(", ")
+        builder.append(name)
+        builder.append('=')
+        table.summaries[i].show(builder)
+    builder.append("}\n")
+    return builder.build()
+
+def writeAll(fd, data):
+    while data: data = data[os.write(fd, data):]
+
+def readAll(fd):
+    pieces = []
     while True:
-        semilen = 1
-        while lines.data[pos + semilen] != ';':
-            if pos + semilen > top: return indices, summaries
-            semilen += 1
-        station = lines.getslice(pos, semilen)
-        pos += semilen + 1
-        nllen = 1
-        while lines.data[pos + nllen] != '\n':
-            if pos + nllen > top: return indices, summaries
-            nllen += 1
-        sample = float(lines.getslice(pos, nllen))
-        pos += nllen + 1
-        if station in indices: summaries[indices[station]].observe(sample)
-        else:
-            indices[station] = len(summaries)
-            summaries.append(Summary(sample))
+        piece = os.read(fd, 65536)
+        if not piece: return "".join(pieces)
+        pieces.append(piece)
+
+def forkWorker(data, start, stop):
+    readEnd, writeEnd = os.pipe()
+    pid = os.fork()
+    if not pid:
+        os.close(readEnd)
+        table = StationTable()
+        collectLines(table, data, start, stop, True)
+        builder = StringBuilder()
+        dumpTable(builder, table)
+        writeAll(writeEnd, builder.build())
+        os._exit(0)
+    os.close(writeEnd)
+    return pid, readEnd
+
+def collectParallel(table, data, start, stop, jobs):
+    bounds = splitRanges(data, start, stop, jobs)
+    workers = [forkWorker(data, bounds[i], bounds[i + 1])
+               for i in range(jobs)]
+    for pid, fd in workers:
+        # Drain the pipe before reaping so that workers never block on a
+        # full pipe buffer.
+        report = readAll(fd)
+        os.close(fd)
+        _, status = os.waitpid(pid, 0)
+        if not os.WIFEXITED(status) or os.WEXITSTATUS(status):
+            raise OSError(0, "worker failed")
+        loadTable(Unpacker(report), table)
+
+# Aggregate the samples from offset onwards. Only the tail of the file is
+# mapped, starting from the allocation granule which holds offset. When
+# checkpointing, a trailing row without its newline is left for next time.
+# Returns the offset of the first byte which was not aggregated.
+def collectFile(table, fd, size, offset, jobs, checkpointing):
+    if offset >= size: return offset
+    base = offset - offset % ALLOCATIONGRANULARITY
+    lines = mmap(fd, size - base, access=ACCESS_READ, offset=base)
+    lines.madvise(MADV_SEQUENTIAL, 0, lines.size)
+    lines.check_valid()
+    data = lines.data
+    start = offset - base
+    stop = lines.size
+    if checkpointing:
+        while stop > start and data[stop - 1] != '\n': stop -= 1
+    if jobs == 1: collectLines(table, data, start, stop, True)
+    else: collectParallel(table, data, start, stop, jobs)
+    lines.close()
+    return base + stop
 
 def main(argv):
-    if len(argv) != 2:
-        print "Usage:", argv[0], "<samples.txt>"
+    jobs = 1
+    path = None
+    checkpoint = None
+    i = 1
+    while i < len(argv):
+        if argv[i] == "-j" and i + 1 < len(argv):
+            jobs = int(argv[i + 1])
+            i += 2
+        elif argv[i] == "-c" and i + 1 < len(argv):
+            checkpoint = argv[i + 1]
+            i += 2
+        elif path is None:
+            path = argv[i]
+            i += 1
+        else: jobs = 0; break
+    if path is None or jobs < 1:
+        print "Usage:", argv[0], "[-j <jobs>] [-c <checkpoint>] <samples.txt>"
+        print "Use - to read from stdin. Pipes and other files which can't"
+        print "be mapped are streamed on one core, regardless of -j."
+        print "With -c, only samples appended since the checkpoint are read,"
+        print "and the checkpoint is then updated."
+        return 1
+    if path == "-" and checkpoint is not None:
+        print "Checkpoints need a regular samples file"
         return 1
-    with open(argv[1], "rb") as handle:
-        lines = mmap(handle.fileno(), 0, access=ACCESS_READ)
-        lines.madvise(MADV_SEQUENTIAL, 0, lines.size)
-        lines.check_valid()
-        indices, summaries = collectLines(lines)
-    print "Number of stations:", len(summaries)
-    i = 0
-    for station in indices:
-        i += 1
-        if i > 3: break
-        print "Station %d (%s):" % (i, station), summaries[indices[station]].show()
+    if path == "-": table = collectStream(0)
+    else:
+        with open(path, "rb") as handle:
+            fd = handle.fileno()
+            st = os.fstat(fd)
+            if not stat.S_ISREG(st.st_mode):
+                if checkpoint is not None:
+                    print "Checkpoints need a regular samples file"
+                    return 1
+                table = collectStream(fd)
+            else:
+                table = StationTable()
+                offset = 0
+                if checkpoint is not None:
+                    try: offset = loadCheckpoint(checkpoint, table)
+                    except ValueError:
+                        print "Not a usable checkpoint:", checkpoint
+                        return 1
+                    if offset > st.st_size:
+                        table = StationTable()
+                        offset = 0
+                offset = collectFile(table, fd, st.st_size, offset, jobs,
+                                     checkpoint is not None)
+                if checkpoint is not None:
+                    saveCheckpoint(checkpoint, table, offset)
+    writeAll(1, showTable(table))
     return 0
 
 def target(*args): return main, None
@@ -1,7 +1,13 @@
-import random
+# -*- coding: utf-8 -*-
+import math, os, sys
+
+from rpython.rlib import rposix
+from rpython.rlib.rarithmetic import r_uint
+from rpython.rlib.rrandom import Random
+from rpython.rlib.rstring import StringBuilder
 
 # Based on https://github.com/ifnesi/1brc/blob/main/createMeasurements.py
-STATIONS = (  # station_name, average_temperature
+STATIONS = [  # station_name, average_temperature
     ("Abha", 18.0),
     ("Abidjan", 26.0),
     ("Abéché", 29.4),
@@ -415,9 +421,202 @@ STATIONS = (  # station_name, average_temperature
     ("Zagreb", 10.7),
     ("Zanzibar City", 26.0),
     ("Zürich", 9.3),
-)
+]
+
+# Synthetic station names are drawn from ASCII letters and a handful of
+# multi-byte UTF-8 characters; a character is never split to hit a length.
+ASCII_CHARS = list("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ")
+NAME_CHARS = ASCII_CHARS + "ä ö ü é ñ ç å ø ß ł ž ğ ı ș Ω λ Ж д 北 京 東 서 울".split(" ")
+
+def synthesizeName(rng, shortest, longest):
+    length = shortest + int(rng.random() * (longest - shortest + 1))
+    pieces = []
+    size = 0
+    while size < length:
+        c = NAME_CHARS[int(rng.random() * len(NAME_CHARS))]
+        if size + len(c) > length:
+            c = ASCII_CHARS[int(rng.random() * len(ASCII_CHARS))]
+        pieces.append(c)
+        size += len(c)
+    return "".join(pieces)
+
+# Make count unique stations with names of shortest to longest bytes, chosen
+# uniformly, and average temperatures between -20 and 30 degrees.
+def synthesizeStations(seed, count, shortest, longest):
+    rng = Random()
+    rng.init_by_array([r_uint(seed)])
+    seen = {}
+    stations = []
+    attempts = 0
+    while len(stations) < count:
+        attempts += 1
+        if attempts > 100 * count + 1000:
+            raise ValueError("too few distinct names of the requested lengths")
+        name = synthesizeName(rng, shortest, longest)
+        if name in seen: continue
+        seen[name] = None
+        stations.append((name, -20.0 + 50.0 * rng.random()))
+    return stations
+
+# Rows are generated in fixed-size blocks. Each block has its own generator,
+# seeded from the seed and the block's index, so the output depends only on
+# the seed, the stations and the row count, and not on how blocks are shared
+# out to jobs.
+BLOCK_ROWS = 1 << 16
+
+def gauss(rng, mu, sigma):
+    # Box-Muller; 1 - random() is never zero.
+    r = math.sqrt(-2.0 * math.log(1.0 - rng.random()))
+    return mu + sigma * r * math.cos(2.0 * math.pi * rng.random())
+
+def appendTenths(builder, t):
+    if t < 0:
+        builder.append('-')
+        t = -t
+    builder.append(str(t // 10))
+    builder.append('.')
+    builder.append(chr(ord('0') + t % 10))
+
+class Generator(object):
+    def __init__(self, rows, seed, stations):
+        self.rows = rows
+        self.seed = seed
+        self.stations = stations
+
+    def blocks(self): return (self.rows + BLOCK_ROWS - 1) // BLOCK_ROWS
+
+    def renderBlock(self, block):
+        rows = min(BLOCK_ROWS, self.rows - block * BLOCK_ROWS)
+        stations = self.stations
+        rng = Random()
+        rng.init_by_array([r_uint(self.seed), r_uint(block)])
+        builder = StringBuilder(rows * 16)
+        for _ in range(rows):
+            station, average = stations[int(rng.random() * len(stations))]
+            t = int(math.floor(gauss(rng, average, 10.0) * 10.0 + 0.5))
+            builder.append(station)
+            builder.append(';')
+            appendTenths(builder, max(-999, min(999, t)))
+            builder.append('\n')
+        return builder.build()
+
+def writeAll(fd, data):
+    while data: data = data[os.write(fd, data):]
+
+def pwriteAll(fd, data, offset):
+    while data:
+        written = rposix.pwrite(fd, data, offset)
+        data = data[written:]
+        offset += written
+
+# Sizes and offsets cross the pipes as fixed-width decimal.
+SIZE_WIDTH = 20
+
+def packSize(n):
+    s = str(n)
+    return "0" * (SIZE_WIDTH - len(s)) + s
+
+def readExactly(fd, n):
+    pieces = []
+    while n:
+        piece = os.read(fd, n)
+        if not piece: raise OSError(0, "worker failed")
+        pieces.append(piece)
+        n -= len(piece)
+    return "".join(pieces)
+
+# Job j renders blocks j, j + jobs, ... in turn. For each block it reports
+# the size, waits to be told the block's offset, and writes it there.
+def renderBlocks(generator, job, jobs, fd, report, offsets):
+    block = job
+    while block < generator.blocks():
+        data = generator.renderBlock(block)
+        writeAll(report, packSize(len(data)))
+        pwriteAll(fd, data, int(readExactly(offsets, SIZE_WIDTH)))
+        block += jobs
+
+def forkRender(generator, job, jobs, fd):
+    reportRead, reportWrite = os.pipe()
+    offsetRead, offsetWrite = os.pipe()
+    pid = os.fork()
+    if not pid:
+        os.close(reportRead)
+        os.close(offsetWrite)
+        renderBlocks(generator, job, jobs, fd, reportWrite, offsetRead)
+        os._exit(0)
+    os.close(reportWrite)
+    os.close(offsetRead)
+    return pid, reportRead, offsetWrite
+
+# Blocks are dealt round-robin to the jobs. Every row is generated once:
+# the parent only hands out running offsets, in block order, and each job
+# writes its own blocks at those offsets.
+def renderParallel(generator, jobs, fd):
+    jobs = min(jobs, generator.blocks())
+    workers = [forkRender(generator, job, jobs, fd) for job in range(jobs)]
+    offset = 0
+    for block in range(generator.blocks()):
+        _, report, offsets = workers[block % jobs]
+        size = int(readExactly(report, SIZE_WIDTH))
+        writeAll(offsets, packSize(offset))
+        offset += size
+    for pid, report, offsets in workers:
+        os.close(report)
+        os.close(offsets)
+        _, status = os.waitpid(pid, 0)
+        if not os.WIFEXITED(status) or os.WEXITSTATUS(status):
+            raise OSError(0, "worker failed")
+
+def main(argv):
+    jobs = 1
+    seed = 0
+    count = 0
+    shortest = 1
+    longest = 100
+    args = []
+    i = 1
+    while i < len(argv):
+        if argv[i] == "-j" and i + 1 < len(argv):
+            jobs = int(argv[i + 1])
+            i += 2
+        elif argv[i] == "-s" and i + 1 < len(argv):
+            seed = int(argv[i + 1])
+            i += 2
+        elif argv[i] == "-k" and i + 1 < len(argv):
+            count = int(argv[i + 1])
+            i += 2
+        elif argv[i] == "-l" and i + 1 < len(argv):
+            shortest = int(argv[i + 1])
+            i += 2
+        elif argv[i] == "-L" and i + 1 < len(argv):
+            longest = int(argv[i + 1])
+            i += 2
+        else:
+            args.append(argv[i])
+            i += 1
+    if len(args) != 2 or jobs < 1 or count < 0 or not 1 <= shortest <= longest:
+        print "Usage:", argv[0], "[-j <jobs>] [-s <seed>] [-k <stations>]",
+        print "[-l <shortest>] [-L <longest>] <rows> <measurements.txt>"
+        print "By default, rows use the built-in list of real stations."
+        print "With -k, that many unique stations are synthesized instead, with"
+        print "UTF-8 names of shortest to longest bytes (default 1 to 100)."
+        return 1
+    if count:
+        try: stations = synthesizeStations(seed, count, shortest, longest)
+        except ValueError:
+            print "Can't make", count, "distinct names of those lengths"
+            return 1
+    else: stations = STATIONS
+    generator = Generator(int(args[0]), seed, stations)
+    fd = os.open(args[1], os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+    try:
+        if jobs == 1:
+            for block in range(generator.blocks()):
+                writeAll(fd, generator.renderBlock(block))
+        else: renderParallel(generator, jobs, fd)
+    finally: os.close(fd)
+    return 0
+
+def target(*args): return main, None
 
-for i in range(1000 * 1000 * 1000):
-    station, average = random.choice(STATIONS)
-    sample = random.gauss(average, 10.0)
-    print("%s;%.1f" % (station, sample))
+if __name__ == "__main__": sys.exit(main(sys.argv))
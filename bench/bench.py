@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+# Benchmark harness for the in-tree interpreters: bf, divspl, 1brc, biia.
+# Runs each translated binary over a fixed corpus, records wall time, peak
+# RSS, and throughput, and optionally compares against a stored baseline.
+
+import argparse
+import fcntl
+import glob
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+BINARIES = "bf", "divspl", "1brc", "1brc-create", "biia"
+
+class Case(object):
+    def __init__(self, name, binary, args, stdin=None, expect=None,
+                 units=None, unit=None, status=0):
+        self.name = name
+        self.binary = binary
+        self.args = args
+        self.stdin = stdin
+        # Expected stdout, if the program's answer is known.
+        self.expect = expect
+        # Work done per run: an int, or a callable over stdout.
+        self.units = units
+        self.unit = unit
+        self.status = status
+
+    def countUnits(self, path, out):
+        if callable(self.units): return self.units(out)
+        return self.units
+
+class BFCase(Case):
+    # Work is the number of optimized nodes executed, which bf -p totals on
+    # the last line of its report. Profiling is slow, so count it once,
+    # outside the timed samples.
+    def __init__(self, name, args, stdin=None, expect=None):
+        Case.__init__(self, name, "bf", args, stdin=stdin, expect=expect,
+                      unit="ops")
+
+    def countUnits(self, path, out):
+        proc = subprocess.run([path, "-p"] + self.args, input=self.stdin,
+                              stdout=subprocess.DEVNULL,
+                              stderr=subprocess.PIPE, check=True)
+        return int(proc.stderr.splitlines()[-1].split()[0])
+
+def countLines(out): return out.count(b"\n")
+def countBoards(out):
+    total = 0
+    for line in out.split(b"\n"):
+        if line.startswith(b"Generation:"): total += int(line.split()[-1])
+    return total
+
+def findBinaries(dirs):
+    found = {}
+    for name in BINARIES:
+        for d in dirs:
+            path = os.path.join(d, name)
+            if os.access(path, os.X_OK):
+                found[name] = path
+                break
+        else:
+            path = shutil.which(name)
+            if path: found[name] = path
+    return found
+
+def writeFile(path, data):
+    with open(path, "w") as handle: handle.write(data)
+
+def corpus(bins, work, rows, numbers):
+    cases = []
+    share = os.path.join(ROOT, "bf", "share")
+    # -n skips bf's program cache, so that every sample pays for parsing and
+    # optimizing and nothing is written into the tree.
+    # laver.b does not terminate; the others finish without input.
+    for prog in "hello.b", "cell-size.b", "mul-const.b", "mul2.b", "mul3.b":
+        cases.append(BFCase("bf/" + prog, ["-n", os.path.join(share, prog)]))
+    cases.append(BFCase("bf/utm.b", ["-n", os.path.join(share, "utm.b")],
+                        stdin=b"b1b1bbb1c1c11111d\n", expect=b"1c11111\n"))
+    # The flake installs a larger benchmark corpus next to the binary.
+    if "bf" in bins:
+        installed = os.path.join(os.path.dirname(bins["bf"]), "..", "share")
+        for prog in sorted(glob.glob(os.path.join(installed, "*.b"))):
+            cases.append(BFCase("bf/share/" + os.path.basename(prog),
+                                ["-n", prog]))
+
+    for prog in "fizzbuzz.divspl", "fizzbuzzfuzz.divspl":
+        cases.append(Case("divspl/" + prog, "divspl",
+                          [os.path.join(ROOT, "divspl", prog)],
+                          units=countLines, unit="numbers"))
+    big = os.path.join(work, "big.divspl")
+    writeFile(big, "1...%d\nFizz=3\nBuzz=5\n" % numbers)
+    cases.append(Case("divspl/big.divspl", "divspl", [big],
+                      units=numbers, unit="numbers"))
+    jobs = os.cpu_count() or 1
+    if jobs > 1:
+        cases.append(Case("divspl/big.divspl-j%d" % jobs, "divspl",
+                          ["-j", str(jobs), big], units=numbers,
+                          unit="numbers"))
+
+    samples = os.path.join(work, "measurements.txt")
+    cases.append(Case("1brc-create", "1brc-create",
+                      ["-s", "1", str(rows), samples], units=rows,
+                      unit="rows"))
+    cases.append(Case("1brc/j1", "1brc", ["-j", "1", samples], units=rows,
+                      unit="rows"))
+    if jobs > 1:
+        cases.append(Case("1brc/j%d" % jobs, "1brc",
+                          ["-j", str(jobs), samples], units=rows,
+                          unit="rows"))
+
+    # biia gives up after five generations, which is the point here.
+    cases.append(Case("biia/tiles.txt", "biia",
+                      [os.path.join(HERE, "tiles.txt")], units=countBoards,
+                      unit="boards", status=1))
+    return cases
+
+# ru_maxrss survives fork and exec, so a binary started from this process
+# reports at least the harness's own peak. On Linux the harness instead
+# becomes a child subreaper and has sh start the binary in the background:
+# sh exits, the orphan is reparented here, and wait4 sees only its own
+# usage. The binary waits on fd 5 so that it cannot finish before sh does
+# and so that sh's startup stays out of the timing.
+TRAMPOLINE = '(exec 3>&-; read go <&5 && exec "$@" <&4 4<&- 5<&-) & echo $! >&3'
+
+def becomeSubreaper():
+    if not sys.platform.startswith("linux"): return False
+    try:
+        import ctypes
+        # PR_SET_CHILD_SUBREAPER
+        return ctypes.CDLL(None).prctl(36, 1, 0, 0, 0) == 0
+    except (ImportError, OSError, AttributeError): return False
+
+def spawn(path, args, fds):
+    pid = os.fork()
+    if not pid:
+        try:
+            # Lift every source clear of the targets first, so that no dup2
+            # can clobber a later source.
+            lifted = [(fcntl.fcntl(src, fcntl.F_DUPFD, 10), dst)
+                      for src, dst in fds]
+            for src, dst in lifted:
+                os.dup2(src, dst)
+                os.close(src)
+            os.execv(path, [path] + args)
+        finally: os._exit(127)
+    return pid
+
+def runDirect(path, args, stdin, out):
+    start = time.perf_counter()
+    pid = spawn(path, args, [(stdin, 0), (out, 1)])
+    _, status, usage = os.wait4(pid, 0)
+    return time.perf_counter() - start, status, usage
+
+def runAdopted(path, args, stdin, out):
+    pidRead, pidWrite = os.pipe()
+    goRead, goWrite = os.pipe()
+    try:
+        sh = spawn("/bin/sh", ["-c", TRAMPOLINE, "sh", path] + args,
+                   [(out, 1), (pidWrite, 3), (stdin, 4), (goRead, 5)])
+        os.close(pidWrite)
+        os.close(goRead)
+        pidWrite = goRead = None
+        os.waitpid(sh, 0)
+        pid = int(os.read(pidRead, 32))
+        start = time.perf_counter()
+        os.write(goWrite, b"\n")
+        _, status, usage = os.wait4(pid, 0)
+        return time.perf_counter() - start, status, usage
+    finally:
+        for fd in pidRead, pidWrite, goRead, goWrite:
+            if fd is not None: os.close(fd)
+
+def runOnce(path, case, adopt):
+    with tempfile.TemporaryFile() as stdin, tempfile.TemporaryFile() as out:
+        if case.stdin: stdin.write(case.stdin)
+        stdin.seek(0)
+        run = runAdopted if adopt else runDirect
+        elapsed, status, usage = run(path, case.args, stdin.fileno(),
+                                     out.fileno())
+        # Only read back output that something will look at; the big cases
+        # write hundreds of megabytes.
+        stdout = None
+        if case.expect is not None or callable(case.units):
+            out.seek(0)
+            stdout = out.read()
+    # ru_maxrss is KiB on Linux but bytes on Darwin.
+    rss = usage.ru_maxrss
+    if sys.platform == "darwin": rss //= 1024
+    return elapsed, rss, os.waitstatus_to_exitcode(status), stdout
+
+def runCase(path, case, samples, warmup, adopt):
+    for _ in range(warmup): runOnce(path, case, adopt)
+    walls = []
+    rss = 0
+    for _ in range(samples):
+        elapsed, peak, status, stdout = runOnce(path, case, adopt)
+        if status != case.status:
+            return {"error": "exit status %d, expected %d"
+                             % (status, case.status)}
+        if case.expect is not None and stdout != case.expect:
+            return {"error": "unexpected output"}
+        walls.append(elapsed)
+        rss = max(rss, peak)
+    median = statistics.median(walls)
+    rv = {
+        "samples": walls,
+        "min": min(walls),
+        "median": median,
+        "mean": statistics.mean(walls),
+        "stdev": statistics.stdev(walls) if len(walls) > 1 else 0.0,
+        "maxrss_kib": rss,
+    }
+    units = case.countUnits(path, stdout)
+    if units is not None:
+        rv["units"] = units
+        rv["unit"] = case.unit
+        rv["throughput"] = units / median if median else None
+    return rv
+
+# Peak RSS of a small binary moves by a few pages between runs.
+RSS_SLACK_KIB = 1024
+
+def compare(results, baseline, tolerance, floor):
+    regressions = []
+    base = baseline["cases"]
+    for name, result in sorted(results["cases"].items()):
+        if name not in base or "error" in result or "error" in base[name]:
+            continue
+        old = base[name]
+        keys = []
+        # Cases faster than the floor mostly time process startup, whose
+        # jitter swamps the program; the fastest sample is the least noisy.
+        if old["min"] >= floor: keys.append("min")
+        if result["maxrss_kib"] - old["maxrss_kib"] > RSS_SLACK_KIB:
+            keys.append("maxrss_kib")
+        for key in keys:
+            if not old[key]: continue
+            ratio = result[key] / old[key]
+            if ratio > 1 + tolerance:
+                regressions.append((name, key, old[key], result[key], ratio))
+    return regressions
+
+def showCase(name, result):
+    if "error" in result:
+        print("%-28s FAILED: %s" % (name, result["error"]))
+        return
+    line = "%-28s %9.4fs +- %.4f  %8d KiB" % (
+        name, result["median"], result["stdev"], result["maxrss_kib"])
+    if result.get("throughput"):
+        line += "  %12.0f %s/s" % (result["throughput"], result["unit"])
+    print(line)
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the in-tree interpreters.")
+    parser.add_argument("-B", "--bin-dir", action="append", default=[],
+                        help="directory containing binaries; may repeat,"
+                             " otherwise $PATH is searched")
+    parser.add_argument("-n", "--samples", type=int, default=5)
+    parser.add_argument("-w", "--warmup", type=int, default=1)
+    parser.add_argument("-k", "--filter", default="",
+                        help="only run cases whose name contains this")
+    parser.add_argument("--rows", type=int, default=10000000,
+                        help="rows of generated 1brc input")
+    parser.add_argument("--numbers", type=int, default=10000000,
+                        help="range of the generated divspl program")
+    parser.add_argument("-o", "--output", help="write JSON results here")
+    parser.add_argument("-b", "--baseline",
+                        help="compare against JSON results in this file")
+    parser.add_argument("-t", "--tolerance", type=float, default=0.1,
+                        help="allowed slowdown before flagging, as a ratio")
+    parser.add_argument("-f", "--floor", type=float, default=0.05,
+                        help="don't compare times of cases whose baseline"
+                             " takes less than this many seconds")
+    args = parser.parse_args(argv[1:])
+
+    bins = findBinaries(args.bin_dir)
+    adopt = becomeSubreaper()
+    work = tempfile.mkdtemp(prefix="rpypkgs-bench-")
+    try:
+        results = {
+            "host": {
+                "machine": platform.machine(),
+                "system": platform.system(),
+                "node": platform.node(),
+                "cpus": os.cpu_count(),
+            },
+            "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "samples": args.samples,
+            "binaries": bins,
+            "cases": {},
+        }
+        cases = corpus(bins, work, args.rows, args.numbers)
+        selected = [c for c in cases if args.filter in c.name]
+        # 1brc needs the generated input even when only it is selected.
+        if any(c.binary == "1brc" for c in selected):
+            selected = [c for c in cases if c.binary == "1brc-create"
+                        and c not in selected] + selected
+        for case in selected:
+            if case.binary not in bins:
+                print("%-28s skipped: no %s binary" % (case.name, case.binary))
+                continue
+            result = runCase(bins[case.binary], case, args.samples,
+                             args.warmup, adopt)
+            results["cases"][case.name] = result
+            showCase(case.name, result)
+    finally: shutil.rmtree(work)
+
+    if args.output:
+        with open(args.output, "w") as handle:
+            json.dump(results, handle, indent=2, sort_keys=True)
+            handle.write("\n")
+
+    failed = any("error" in r for r in results["cases"].values())
+    if args.baseline:
+        with open(args.baseline) as handle: baseline = json.load(handle)
+        regressions = compare(results, baseline, args.tolerance,
+                              args.floor)
+        for name, key, old, new, ratio in regressions:
+            print("REGRESSION %s %s: %.4g -> %.4g (%+.1f%%)"
+                  % (name, key, old, new, (ratio - 1) * 100))
+        if not regressions: print("No regressions against", args.baseline)
+        failed = failed or bool(regressions)
+    return 1 if failed else 0
+
+if __name__ == "__main__": sys.exit(main(sys.argv))
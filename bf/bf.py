@@ -7,9 +7,11 @@ import os
 import sys
 
 from rpython.jit.codewriter.policy import JitPolicy
-from rpython.rlib.jit import JitDriver, unroll_safe
+from rpython.rlib.jit import JitDriver, dont_look_inside, unroll_safe
 from rpython.rlib.listsort import make_timsort_class
 from rpython.rlib.objectmodel import import_from_mixin, specialize
+from rpython.rlib.rarithmetic import intmask
+from rpython.rlib.rsha import sha
 
 # Initial-coded tokens for whether offsets are absolute or relative.
 class Offset(object): pass
@@ -20,6 +22,7 @@ ABS = Absolute(); REL = Relative()
 # https://esolangs.org/wiki/Algebraic_Brainfuck
 # v1: builtins, monoid, zero, move, move2, scalemove, scalemove2
 # v2: propagate
+# v3: scan, affine
 class BF(object):
     def propagate(self, adjust, diffs): pass
     def unit(self): return self.propagate(0, {})
@@ -38,6 +41,11 @@ class BF(object):
         return self.loop([
             self.propagate(0, {0: (REL, -1), i: (REL, s), j: (REL, t)}),
         ])
+    def scan(self, i): return self.loop([self.right(i)])
+    def affine(self, diffs):
+        diffs = diffs.copy()
+        diffs[0] = REL, -1
+        return self.loop([self.propagate(0, diffs)])
 
 KeySort = make_timsort_class(lt=lambda l, r: l[0] < r[0])
 
@@ -67,34 +75,124 @@ class AsStr(object):
     def input(self): return ','
     def output(self): return '.'
 
-jitdriver = JitDriver(greens=['op'], reds=['position', 'tape'])
+class Tape(object):
+    # Unbounded in both directions; cells outside of the array read as zero.
+    # Cells are machine words masked to the chosen width, so every width
+    # shares this one class and ops never dispatch on it.
+    _immutable_fields_ = "mask",
+    def __init__(self, mask, size):
+        self.mask = mask
+        self.cells = [0] * size
+    def get(self, position):
+        if 0 <= position < len(self.cells): return self.cells[position]
+        return 0
+    def set(self, position, v): self.cells[position] = intmask(v) & self.mask
+    def add(self, position, v):
+        self.cells[position] = intmask(self.cells[position] + v) & self.mask
+    # Make cells position+low through position+high writeable. Growing to
+    # the left moves every cell, so callers must use the returned position.
+    def reserve(self, position, low, high):
+        size = len(self.cells)
+        if position + low < 0:
+            extra = max(size, -(position + low))
+            self.cells = [0] * extra + self.cells
+            position += extra
+            size += extra
+        if position + high >= size:
+            extra = max(size, position + high + 1 - size)
+            self.cells = self.cells + [0] * extra
+        return position
+    # Residual call: a tight loop beats tracing one iteration per cell.
+    @dont_look_inside
+    def scan(self, position, stride):
+        cells = self.cells
+        while 0 <= position < len(cells) and cells[position]:
+            position += stride
+        return position
+
+WIDTHS = 8, 16, 32, 0
+
+# "Unbounded" cells are whole machine words, which no sane program
+# overflows.
+def makeTape(bits, size):
+    if bits == 8: mask = 0xff
+    elif bits == 16: mask = 0xffff
+    elif bits == 32: mask = intmask(0xffffffff)
+    else: mask = -1
+    return Tape(mask, size)
+
+def diffBounds(diffs):
+    low = high = 0
+    for (k, _) in diffs:
+        if k < low: low = k
+        elif k > high: high = k
+    return low, high
+
+jitdriver = JitDriver(greens=['op'], reds=['position', 'tape'],
+                      is_recursive=True)
 
 class Op(object): _immutable_ = True
 
+def writeAll(fd, s):
+    while s: s = s[os.write(fd, s):]
+
+BUFFER_SIZE = 1 << 16
+
+class Stdio(object):
+    # Output is flushed when full, before reading might block, and at exit;
+    # -u makes every byte its own syscall again, for interactive programs.
+    def __init__(self):
+        self.buffered = True
+        self.out = []
+        self.inbuf = ""
+        self.inpos = 0
+    def write(self, c):
+        self.out.append(c)
+        if not self.buffered or len(self.out) >= BUFFER_SIZE: self.flush()
+    def flush(self):
+        if self.out:
+            writeAll(1, ''.join(self.out))
+            self.out = []
+    # EOF reads as 0.
+    def read(self):
+        if self.inpos >= len(self.inbuf):
+            self.flush()
+            self.inbuf = os.read(0, BUFFER_SIZE if self.buffered else 1)
+            self.inpos = 0
+            if not self.inbuf: return 0
+        c = self.inbuf[self.inpos]
+        self.inpos += 1
+        return ord(c)
+stdio = Stdio()
+
 class _Input(Op):
     _immutable_ = True
     def runOn(self, tape, position):
-        tape[position] = ord(os.read(0, 1)[0])
+        position = tape.reserve(position, 0, 0)
+        tape.set(position, stdio.read())
         return position
 Input = _Input()
 class _Output(Op):
     _immutable_ = True
     def runOn(self, tape, position):
-        os.write(1, chr(tape[position]))
+        stdio.write(chr(tape.get(position) & 0xff))
         return position
 Output = _Output()
 class Propagate(Op):
     _immutable_ = True
-    _immutable_fields_ = "adjust", "diffs[*]"
+    _immutable_fields_ = "adjust", "diffs[*]", "low", "high"
     def __init__(self, adjust, diffs):
         self.adjust = adjust
         self.diffs = diffs
+        self.low, self.high = diffBounds(diffs)
     @unroll_safe
     def runOn(self, tape, position):
-        for (k, (ty, v)) in self.diffs:
-            if   ty is ABS: tape[position + k] = v
-            elif ty is REL: tape[position + k] += v
-            else: assert False, "offsetting"
+        if self.diffs:
+            position = tape.reserve(position, self.low, self.high)
+            for (k, (ty, v)) in self.diffs:
+                if   ty is ABS: tape.set(position + k, v)
+                elif ty is REL: tape.add(position + k, v)
+                else: assert False, "offsetting"
         return position + self.adjust
 class ZeroScaleAdd(Op):
     _immutable_ = True
@@ -103,29 +201,57 @@ class ZeroScaleAdd(Op):
         self.offset = offset
         self.scale = scale
     def runOn(self, tape, position):
-        tape[position + self.offset] += tape[position] * self.scale
-        tape[position] = 0
+        position = tape.reserve(position, min(0, self.offset),
+                                max(0, self.offset))
+        tape.add(position + self.offset, tape.get(position) * self.scale)
+        tape.set(position, 0)
         return position
 class ZeroScaleAdd2(Op):
     _immutable_ = True
-    _immutable_fields_ = "offset1", "scale1", "offset2", "scale2"
+    _immutable_fields_ = "offset1", "scale1", "offset2", "scale2", "low", "high"
     def __init__(self, offset1, scale1, offset2, scale2):
         self.offset1 = offset1
         self.scale1 = scale1
         self.offset2 = offset2
         self.scale2 = scale2
+        self.low = min(0, min(offset1, offset2))
+        self.high = max(0, max(offset1, offset2))
     def runOn(self, tape, position):
-        tape[position + self.offset1] += tape[position] * self.scale1
-        tape[position + self.offset2] += tape[position] * self.scale2
-        tape[position] = 0
+        position = tape.reserve(position, self.low, self.high)
+        n = tape.get(position)
+        tape.add(position + self.offset1, n * self.scale1)
+        tape.add(position + self.offset2, n * self.scale2)
+        tape.set(position, 0)
         return position
+class Affine(Op):
+    _immutable_ = True
+    _immutable_fields_ = "diffs[*]", "low", "high"
+    def __init__(self, diffs):
+        self.diffs = diffs
+        self.low, self.high = diffBounds(diffs)
+    @unroll_safe
+    def runOn(self, tape, position):
+        n = tape.get(position)
+        if not n: return position
+        position = tape.reserve(position, self.low, self.high)
+        for (k, (ty, v)) in self.diffs:
+            if   ty is ABS: tape.set(position + k, v)
+            elif ty is REL: tape.add(position + k, n * v)
+            else: assert False, "affronting"
+        tape.set(position, 0)
+        return position
+class Scan(Op):
+    _immutable_ = True
+    _immutable_fields_ = "stride",
+    def __init__(self, stride): self.stride = stride
+    def runOn(self, tape, position): return tape.scan(position, self.stride)
 class Loop(Op):
     _immutable_ = True
     _immutable_fields_ = "op",
     def __init__(self, op): self.op = op
     def runOn(self, tape, position):
         op = self.op
-        while tape[position]:
+        while tape.get(position):
             jitdriver.jit_merge_point(op=op, position=position, tape=tape)
             position = op.runOn(tape, position)
         return position
@@ -156,67 +282,395 @@ class AsOps(object):
     def output(self): return Output
     def scalemove(self, i, s): return ZeroScaleAdd(i, s)
     def scalemove2(self, i, s, j, t): return ZeroScaleAdd2(i, s, j, t)
+    def scan(self, i): return Scan(i)
+    def affine(self, diffs):
+        ds = diffs.items()
+        KeySort(ds).sort()
+        return Affine(ds)
+
+# Profiling: every node counts its executions, and loops also count their
+# iterations. Nodes are labelled with their minimized rendering.
+class Tally(object):
+    def __init__(self, kind, label):
+        self.kind = kind
+        self.label = label
+        self.count = 0
+
+class Profile(object):
+    def __init__(self): self.tallies = []
+profile = Profile()
+
+class Counted(Op):
+    _immutable_ = True
+    _immutable_fields_ = "op", "tally"
+    def __init__(self, op, tally):
+        self.op = op
+        self.tally = tally
+    def runOn(self, tape, position):
+        self.tally.count += 1
+        return self.op.runOn(tape, position)
+
+def counted(kind, label, op):
+    tally = Tally(kind, label)
+    profile.tallies.append(tally)
+    return Counted(op, tally)
+
+class AsProfiled(object):
+    import_from_mixin(BF)
+    def propagate(self, adjust, diffs):
+        return counted("propagate", rawStr.propagate(adjust, diffs),
+                       rawOps.propagate(adjust, diffs))
+    def loop(self, bfs):
+        label = rawStr.loop([bf.tally.label for bf in bfs])
+        body = counted("iteration", label, Seq([bf for bf in bfs]))
+        return counted("loop", label, Loop(body))
+    def input(self): return counted("input", rawStr.input(), rawOps.input())
+    def output(self): return counted("output", rawStr.output(), rawOps.output())
+    def scalemove(self, i, s):
+        return counted("scalemove", rawStr.scalemove(i, s),
+                       rawOps.scalemove(i, s))
+    def scalemove2(self, i, s, j, t):
+        return counted("scalemove2", rawStr.scalemove2(i, s, j, t),
+                       rawOps.scalemove2(i, s, j, t))
+    def scan(self, i): return counted("scan", rawStr.scan(i), rawOps.scan(i))
+    def affine(self, diffs):
+        return counted("affine", rawStr.affine(diffs), rawOps.affine(diffs))
+
+TallySort = make_timsort_class(lt=lambda l, r: l.count > r.count)
+
+def profileLine(count, kind, label):
+    if len(label) > 60: label = label[:57] + "..."
+    return " " * max(0, 12 - len(count)) + count + "  " + kind + \
+           " " * max(0, 12 - len(kind)) + label
+
+def showProfile(limit):
+    tallies = [t for t in profile.tallies if t.count]
+    TallySort(tallies).sort()
+    lines = [profileLine("count", "kind", "node")]
+    for tally in tallies[:limit]:
+        lines.append(profileLine(str(tally.count), tally.kind, tally.label))
+    total = 0
+    for tally in tallies: total += tally.count
+    lines.append(profileLine(str(total), "total", "all nodes"))
+    writeAll(2, "\n".join(lines) + "\n")
+
+# Flat bytecode: each instruction is an opcode and its operands, and jumps
+# are relative to the jumping instruction, so fragments can be
+# concatenated freely. PROPAGATE and AFFINE carry the bounds of the cells
+# they touch, then a count of (SET|ADD|MULADD, offset, value) triples.
+PROPAGATE, AFFINE, MOVE, SCAN, INPUT, OUTPUT, JUMP_ZERO, JUMP_NONZERO = range(8)
+SET, ADD, MULADD = range(3)
+
+def packTriples(code, ds, rel):
+    low, high = diffBounds(ds)
+    code.extend([low, high, len(ds)])
+    for (k, (ty, v)) in ds: code.extend([SET if ty is ABS else rel, k, v])
+
+class AsCode(object):
+    import_from_mixin(BF)
+    def join(self, l, r): return l + r
+    def propagate(self, adjust, diffs):
+        if not diffs: return [MOVE, adjust] if adjust else []
+        ds = diffs.items()
+        KeySort(ds).sort()
+        code = [PROPAGATE, adjust]
+        packTriples(code, ds, ADD)
+        return code
+    def loop(self, bfs):
+        body = []
+        for bf in bfs: body.extend(bf)
+        return [JUMP_ZERO, len(body) + 4] + body + [JUMP_NONZERO, -len(body)]
+    def input(self): return [INPUT]
+    def output(self): return [OUTPUT]
+    def scalemove(self, i, s): return self.affine({i: (REL, s)})
+    def scalemove2(self, i, s, j, t):
+        return self.affine({i: (REL, s), j: (REL, t)})
+    def scan(self, i): return [SCAN, i]
+    def affine(self, diffs):
+        ds = diffs.items()
+        KeySort(ds).sort()
+        code = [AFFINE]
+        packTriples(code, ds, MULADD)
+        return code
+
+class Program(object):
+    _immutable_ = True
+    _immutable_fields_ = "code[*]",
+    def __init__(self, code): self.code = code
 
-# https://graphics.stanford.edu/~seander/bithacks.html#DetermineIfPowerOf2
-# Special case for i=1, whose orbit does include 0!
-def orbitReachesZero(i): return bool((abs(i) & 1) | (abs(i) & (abs(i) - 1)))
+def location(pc, program): return "pc %d: opcode %d" % (pc, program.code[pc])
+codedriver = JitDriver(greens=['pc', 'program'], reds=['position', 'tape'],
+                       get_printable_location=location, is_recursive=True)
+
+# Program code is never resized, so build it at its final size.
+def flatten(frags):
+    size = 0
+    for frag in frags: size += len(frag)
+    code = [0] * size
+    pc = 0
+    for frag in frags:
+        for op in frag:
+            code[pc] = op
+            pc += 1
+    return code
+
+def runCode(program, tape, position):
+    pc = 0
+    while pc < len(program.code):
+        codedriver.jit_merge_point(pc=pc, program=program,
+                                   position=position, tape=tape)
+        code = program.code
+        op = code[pc]
+        if op == PROPAGATE:
+            adjust = code[pc + 1]
+            position = tape.reserve(position, code[pc + 2], code[pc + 3])
+            i = pc + 5
+            pc = i + 3 * code[pc + 4]
+            while i < pc:
+                if code[i] == SET: tape.set(position + code[i + 1], code[i + 2])
+                else: tape.add(position + code[i + 1], code[i + 2])
+                i += 3
+            position += adjust
+        elif op == MOVE:
+            position += code[pc + 1]
+            pc += 2
+        elif op == JUMP_NONZERO:
+            if tape.get(position):
+                pc += code[pc + 1]
+                codedriver.can_enter_jit(pc=pc, program=program,
+                                         position=position, tape=tape)
+            else: pc += 2
+        elif op == JUMP_ZERO:
+            if tape.get(position): pc += 2
+            else: pc += code[pc + 1]
+        elif op == AFFINE:
+            n = tape.get(position)
+            i = pc + 4
+            end = i + 3 * code[pc + 3]
+            if n:
+                position = tape.reserve(position, code[pc + 1], code[pc + 2])
+                while i < end:
+                    if code[i] == SET: tape.set(position + code[i + 1], code[i + 2])
+                    else: tape.add(position + code[i + 1], n * code[i + 2])
+                    i += 3
+                tape.set(position, 0)
+            pc = end
+        elif op == SCAN:
+            position = tape.scan(position, code[pc + 1])
+            pc += 2
+        elif op == INPUT:
+            position = tape.reserve(position, 0, 0)
+            tape.set(position, stdio.read())
+            pc += 1
+        elif op == OUTPUT:
+            stdio.write(chr(tape.get(position) & 0xff))
+            pc += 1
+        else: assert False, "opcodeless"
+    return position
+
+# Compact encoding of optimized programs, for the on-disk cache. Integers
+# are zigzagged and then little-endian base 128.
+def packInt(pieces, n):
+    u = n << 1 if n >= 0 else ((-n) << 1) - 1
+    while u >= 0x80:
+        pieces.append(chr(0x80 | (u & 0x7f)))
+        u >>= 7
+    pieces.append(chr(u))
+
+def packDiffs(pieces, diffs):
+    ds = diffs.items()
+    KeySort(ds).sort()
+    packInt(pieces, len(ds))
+    for (k, (ty, v)) in ds:
+        packInt(pieces, k)
+        pieces.append("=" if ty is ABS else "+")
+        packInt(pieces, v)
+
+def packOps(pieces, bfs):
+    packInt(pieces, len(bfs))
+    pieces.extend(bfs)
+
+class AsBytes(object):
+    import_from_mixin(BF)
+    def join(self, l, r): return l + r
+    def propagate(self, adjust, diffs):
+        pieces = ["p"]
+        packInt(pieces, adjust)
+        packDiffs(pieces, diffs)
+        return ''.join(pieces)
+    def loop(self, bfs):
+        pieces = ["["]
+        packOps(pieces, bfs)
+        return ''.join(pieces)
+    def input(self): return ","
+    def output(self): return "."
+    def scalemove(self, i, s):
+        pieces = ["m"]
+        packInt(pieces, i)
+        packInt(pieces, s)
+        return ''.join(pieces)
+    def scalemove2(self, i, s, j, t):
+        pieces = ["M"]
+        packInt(pieces, i)
+        packInt(pieces, s)
+        packInt(pieces, j)
+        packInt(pieces, t)
+        return ''.join(pieces)
+    def scan(self, i):
+        pieces = ["s"]
+        packInt(pieces, i)
+        return ''.join(pieces)
+    def affine(self, diffs):
+        pieces = ["a"]
+        packDiffs(pieces, diffs)
+        return ''.join(pieces)
+
+class CorruptCache(Exception): pass
+
+class Decoder(object):
+    def __init__(self, data, pos):
+        self.data = data
+        self.pos = pos
+    def byte(self):
+        if self.pos >= len(self.data): raise CorruptCache()
+        c = self.data[self.pos]
+        self.pos += 1
+        return c
+    def int(self):
+        u = shift = 0
+        while True:
+            if shift > 63: raise CorruptCache()
+            b = ord(self.byte())
+            u |= (b & 0x7f) << shift
+            shift += 7
+            if not b & 0x80: break
+        return -(u >> 1) - 1 if u & 1 else u >> 1
+    def diffs(self):
+        diffs = {}
+        for _ in range(self.int()):
+            k = self.int()
+            ty = ABS if self.byte() == "=" else REL
+            diffs[k] = ty, self.int()
+        return diffs
+    @specialize.argtype(1)
+    def ops(self, domain):
+        return [self.op(domain) for _ in range(self.int())]
+    @specialize.argtype(1)
+    def op(self, domain):
+        c = self.byte()
+        if c == "p":
+            adjust = self.int()
+            return domain.propagate(adjust, self.diffs())
+        elif c == "[": return domain.loop(self.ops(domain))
+        elif c == ",": return domain.input()
+        elif c == ".": return domain.output()
+        elif c == "m":
+            i = self.int()
+            return domain.scalemove(i, self.int())
+        elif c == "M":
+            i = self.int()
+            s = self.int()
+            j = self.int()
+            return domain.scalemove2(i, s, j, self.int())
+        elif c == "s": return domain.scan(self.int())
+        elif c == "a": return domain.affine(self.diffs())
+        raise CorruptCache()
+
+# Stepping a cell by i reaches zero from every value exactly when i is
+# invertible modulo 2**bits, i.e. odd; without wraparound, only steps of 1.
+def orbitReachesZero(i, bits):
+    if bits: return bool(i & 1)
+    return abs(i) == 1
 
 def makePeephole(cls):
-    # Optimization domain is a tuple of: (underlying domain, adjust, diffs)
-    # (diffs is None <=> is not propagator)
+    # Optimization domain is a tuple of:
+    # (underlying domain, adjust, diffs, I/O)
+    # (diffs is None <=> is not propagator; I/O is "," or "." or None)
     domain = cls()
     def stripDomain(bfs): return [t[0] for t in bfs]
     def isProp(t): return t[2] is not None
+    def isIO(t): return t[3] is not None
 
     class Peephole(object):
         import_from_mixin(BF)
+        # Cell width in bits, or 0 for unbounded cells.
+        def __init__(self, bits): self.bits = bits
         def unit(self): return []
         def join(self, l, r):
             if not len(l): return r
             if not len(r): return l
+            if isProp(r[0]) and isIO(l[-1]): return self.sink(l, r)
             if not isProp(l[-1]) or not isProp(r[0]): return l + r
-            _, ladj, lds = l[-1]
-            _, radj, rds = r[0]
+            _, ladj, lds, _ = l[-1]
+            _, radj, rds, _ = r[0]
             adjust = ladj + radj
             diffs = lds.copy()
             for (k, (rty, rv)) in rds.iteritems():
                 lty, lv = diffs.get(ladj + k, (REL, 0))
                 if   rty is ABS: diffs[ladj + k] = ABS, rv
-                elif rty is REL: diffs[ladj + k] = lty, lv + rv
+                elif rty is REL:
+                    if lty is ABS or lv + rv: diffs[ladj + k] = lty, lv + rv
+                    elif ladj + k in diffs: del diffs[ladj + k]
                 else: assert False, "offputting"
             return l[:-1] + self.propagate(adjust, diffs) + r[1:]
+        # I/O only touches the current cell, so a propagator's other diffs
+        # commute past it and can fuse with the next propagator. A diff to
+        # the current cell is dead if input overwrites it first.
+        def sink(self, l, r):
+            i = len(l) - 1
+            while i >= 0 and isIO(l[i]): i -= 1
+            if i < 0 or not isProp(l[i]): return l + r
+            _, adjust, ds, _ = l[i]
+            kept = {}
+            moved = {}
+            for (k, d) in ds.iteritems():
+                if k != adjust: moved[k - adjust] = d
+                elif l[i + 1][3] != ",": kept[k] = d
+            if kept or adjust: l = l[:i] + self.propagate(adjust, kept) + l[i + 1:]
+            else: l = l[:i] + l[i + 1:]
+            return l + self.join(self.propagate(0, moved), r)
         def propagate(self, adjust, diffs):
-            return [(domain.propagate(adjust, diffs), adjust, diffs)]
+            return [(domain.propagate(adjust, diffs), adjust, diffs, None)]
         def loop(self, bfs):
             ts = []
             for bf in bfs: ts.extend(bf)
             # Loopish pattern recognition.
             if len(ts) == 1 and isProp(ts[0]):
-                bf, adjust, diffs = ts[0]
-                if adjust == 0 and 0 in diffs:
+                bf, adjust, diffs, _ = ts[0]
+                if adjust and not diffs: return [(domain.scan(adjust), 0, None, None)]
+                elif adjust == 0 and 0 in diffs:
                     diffs = diffs.copy()
                     ty, v = diffs[0]
                     del diffs[0]
-                    if len(diffs) == 0 and orbitReachesZero(v) and ty is REL:
+                    if len(diffs) == 0 and orbitReachesZero(v, self.bits) and ty is REL:
                         return self.zero()
-                    elif len(diffs) == 1:
-                        ik, (ity, iv) = diffs.items()[0]
-                        if ty is REL and v == -1 and ity is REL:
-                            return [(domain.scalemove(ik, iv), 0, None)]
-                        # XXX could also add new op for ABS ity
-                    elif len(diffs) == 2:
+                    elif ty is REL and v == -1:
                         dis = diffs.items()
-                        ik, (ity, iv) = dis[0]
-                        jk, (jty, jv) = dis[1]
-                        if ty is REL and v == -1 and ity is jty is REL:
-                            return [(domain.scalemove2(ik, iv, jk, jv), 0, None)]
-            return [(domain.loop(stripDomain(ts)), 0, None)]
-        def input(self): return [(domain.input(), 0, None)]
-        def output(self): return [(domain.output(), 0, None)]
+                        if len(dis) == 1:
+                            ik, (ity, iv) = dis[0]
+                            if ity is REL:
+                                return [(domain.scalemove(ik, iv), 0, None, None)]
+                        elif len(dis) == 2:
+                            ik, (ity, iv) = dis[0]
+                            jk, (jty, jv) = dis[1]
+                            if ity is jty is REL:
+                                return [(domain.scalemove2(ik, iv, jk, jv), 0, None, None)]
+                        # Any other balanced loop runs exactly tape[0] times.
+                        return [(domain.affine(diffs), 0, None, None)]
+            return [(domain.loop(stripDomain(ts)), 0, None, None)]
+        def input(self): return [(domain.input(), 0, None, ",")]
+        def output(self): return [(domain.output(), 0, None, ".")]
     return Peephole, stripDomain
 
+# Cached programs are already optimized, so they decode straight into ops.
+rawOps = AsOps()
+rawCode = AsCode()
+rawStr = AsStr()
 AsStr, finishStr = makePeephole(AsStr)
 AsOps, finishOps = makePeephole(AsOps)
+AsCode, finishCode = makePeephole(AsCode)
+AsBytes, finishBytes = makePeephole(AsBytes)
+AsProfiled, finishProfiled = makePeephole(AsProfiled)
 
 def parsePropagator(s, i):
     pointer = 0
@@ -274,23 +728,111 @@ def parse(s, domain):
 
     return ops.pop()
 
+def readAll(fd):
+    pieces = []
+    while True:
+        piece = os.read(fd, BUFFER_SIZE)
+        if not piece: break
+        pieces.append(piece)
+    return ''.join(pieces)
+
+# Bump the version whenever the optimizer or the encoding changes.
+CACHE_MAGIC = "bfc\x03"
+
+@specialize.argtype(2)
+def loadCache(path, header, domain):
+    try: fd = os.open(path, os.O_RDONLY, 0)
+    except OSError: return None
+    try: data = readAll(fd)
+    finally: os.close(fd)
+    if not data.startswith(header): return None
+    decoder = Decoder(data, len(header))
+    try:
+        ops = decoder.ops(domain)
+        if decoder.pos != len(data): return None
+    except CorruptCache: return None
+    return ops
+
+# Failing to write the cache, e.g. next to a read-only program, is harmless.
+def saveCache(path, data):
+    tmp = "%s.%d" % (path, os.getpid())
+    try:
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+        try: writeAll(fd, data)
+        finally: os.close(fd)
+        os.rename(tmp, path)
+    except OSError:
+        try: os.unlink(tmp)
+        except OSError: pass
+
+# The optimized program is cached next to its source, keyed by its hash
+# and by the cell width it was optimized for.
+@specialize.argtype(2)
+def compileCached(text, path, domain, bits):
+    header = CACHE_MAGIC + chr(bits) + sha(text).digest()
+    ops = loadCache(path, header, domain)
+    if ops is None:
+        pieces = [header]
+        packOps(pieces, finishBytes(parse(text, AsBytes(bits))))
+        data = ''.join(pieces)
+        saveCache(path, data)
+        ops = Decoder(data, len(header)).ops(domain)
+    return ops
+
 def entryPoint(argv):
     if len(argv) < 2 or "-h" in argv:
-        print "Usage: bf [-c <number of cells>] [-h] [-o] <program.bf>"
+        print "Usage: bf [-b] [-c <initial number of cells>] [-h] [-n] [-o] [-p] [-u] [-w <cell width>] <program.bf>"
         print "To dump a minimized optimized program: bf -o <program.bf>"
+        print "To read and write unbuffered, e.g. interactively: bf -u <program.bf>"
+        print "Optimized programs are cached in <program.bf>c; -n skips the cache"
+        print "To run flat bytecode instead of the op tree: bf -b <program.bf>"
+        print "To report the hottest nodes on stderr afterwards: bf -p <program.bf>"
+        print "Cells are 8, 16, or 32 bits and wrap, or 0 for unbounded; default 8"
+        return 1
+    # The tape grows as needed; this is only where it starts.
+    cells = 1024
+    minimize = False
+    cached = True
+    bytecode = False
+    profiling = False
+    bits = 8
+    i = 1
+    while i < len(argv) - 1:
+        if argv[i] == "-b": bytecode = True
+        elif argv[i] == "-c":
+            cells = int(argv[i + 1])
+            i += 1
+        elif argv[i] == "-n": cached = False
+        elif argv[i] == "-o": minimize = True
+        elif argv[i] == "-p": profiling = True
+        elif argv[i] == "-u": stdio.buffered = False
+        elif argv[i] == "-w":
+            bits = int(argv[i + 1])
+            i += 1
+        i += 1
+    if bits not in WIDTHS:
+        print "Unsupported cell width %d" % bits
         return 1
-    cells = 30000
-    if argv[1] == "-c":
-        cells = int(argv[2])
-        path = argv[3]
-    elif argv[1] == "-o": path = argv[2]
-    else: path = argv[1]
+    path = argv[-1]
     with open(path) as handle: text = handle.read()
-    if "-o" in argv:
-        print ''.join(finishStr(parse(text, AsStr())))
+    if minimize:
+        print ''.join(finishStr(parse(text, AsStr(bits))))
         return 0
-    tape = bytearray("\x00" * cells)
-    Seq(finishOps(parse(text, AsOps()))).runOn(tape, 0)
+    tape = makeTape(bits, cells)
+    try:
+        if profiling:
+            Seq(finishProfiled(parse(text, AsProfiled(bits)))).runOn(tape, 0)
+            stdio.flush()
+            showProfile(30)
+        elif bytecode:
+            if cached: frags = compileCached(text, path + "c", rawCode, bits)
+            else: frags = finishCode(parse(text, AsCode(bits)))
+            runCode(Program(flatten(frags)), tape, 0)
+        else:
+            if cached: ops = compileCached(text, path + "c", rawOps, bits)
+            else: ops = finishOps(parse(text, AsOps(bits)))
+            Seq(ops).runOn(tape, 0)
+    finally: stdio.flush()
     return 0
 
 def target(*args): return entryPoint, None
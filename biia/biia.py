@@ -2,6 +2,8 @@
 
 import sys
 
+from rpython.rlib.rarithmetic import LONG_BIT, r_uint
+
 SP = ord(' ')
 
 def maxList(l):
@@ -10,16 +12,12 @@ def maxList(l):
         if x > rv: rv = x
     return rv
 
-def anyList(l):
-    for x in l:
-        if x: return True
-    return False
-
 class Canvas(object):
     def __init__(self, arr, h, w):
         self.arr = arr
         self.h = h
         self.w = w
+        self.shifts = {}
 
     def at(self, i, j): return self.arr[j + i * self.w]
     def set(self, i, j, c): self.arr[j + i * self.w] = c
@@ -29,34 +27,102 @@ class Canvas(object):
                                    for j in range(self.w)])
                           for i in range(self.h)])
 
-    def isFull(self):
-        return not anyList([self.arr[i] == SP for i in range(self.h * self.w)])
     def canStart(self): return self.arr[0] != SP
 
+    # Spaces are transparent.
+    def paint(self, tile, x, y):
+        for i in range(tile.h):
+            for j in range(tile.w):
+                c = tile.at(i, j)
+                if c != SP: self.set(x + i, y + j, c)
+
+    # The same few shifts of each tile are tried against every board.
+    def shifted(self, y):
+        if y not in self.shifts: self.shifts[y] = Mask(self, y)
+        return self.shifts[y]
+
+def wordsFor(w): return (w + LONG_BIT - 1) // LONG_BIT
+
+# Occupancy of each row as bits, in words-sized runs of machine words.
+class Mask(object):
+    def __init__(self, tile, y):
+        self.words = wordsFor(y + tile.w)
+        self.rows = [r_uint(0)] * (tile.h * self.words)
+        for i in range(tile.h):
+            for j in range(tile.w):
+                if tile.at(i, j) != SP:
+                    b = y + j
+                    self.rows[i * self.words + b // LONG_BIT] |= \
+                        r_uint(1) << (b % LONG_BIT)
+
+# A search state is only its occupancy and the placement which made it;
+# characters are painted when it is printed.
+class Board(object):
+    def __init__(self, h, w, rows, parent, tile, x, y):
+        self.h = h
+        self.w = w
+        self.words = wordsFor(w)
+        self.rows = rows
+        self.parent = parent
+        self.tile = tile
+        self.x = x
+        self.y = y
+
+    # Mask of the columns in word k.
+    def full(self, k):
+        if (k + 1) * LONG_BIT <= self.w: return ~r_uint(0)
+        return (r_uint(1) << (self.w - k * LONG_BIT)) - 1
+
+    def isFull(self):
+        for i in range(self.h):
+            for k in range(self.words):
+                if self.rows[i * self.words + k] != self.full(k): return False
+        return True
+
+    # The first row and the first column which have a hole.
     def interior(self):
         maxh = self.h
         maxw = self.w
         for i in range(self.h):
-            for j in range(self.w):
-                if self.at(i, j) == SP:
-                    maxh = min(maxh, i)
-                    maxw = min(maxw, j)
+            for k in range(self.words):
+                holes = ~self.rows[i * self.words + k] & self.full(k)
+                if not holes: continue
+                maxh = min(maxh, i)
+                j = k * LONG_BIT
+                while not holes & 1:
+                    holes >>= 1
+                    j += 1
+                maxw = min(maxw, j)
         return maxh, maxw
 
     def fit(self, tile, x, y):
+        mask = tile.shifted(y)
+        words = min(self.words, mask.words)
         for i in range(x, min(self.h, x + tile.h)):
-            for j in range(y, min(self.w, y + tile.w)):
-                if self.at(i, j) != SP and tile.at(x - i, y - j) != SP:
-                    return None
-        rv = blank(max(self.h, x + tile.h), max(self.w, y + tile.w))
-        rv.blit(self, 0, 0)
-        rv.blit(tile, x, y)
+            for k in range(words):
+                if (self.rows[i * self.words + k] &
+                    mask.rows[(i - x) * mask.words + k]): return None
+        h = max(self.h, x + tile.h)
+        w = max(self.w, y + tile.w)
+        rv = Board(h, w, [r_uint(0)] * (h * wordsFor(w)), self, tile, x, y)
+        for i in range(self.h):
+            for k in range(self.words):
+                rv.rows[i * rv.words + k] = self.rows[i * self.words + k]
+        for i in range(tile.h):
+            for k in range(mask.words):
+                rv.rows[(x + i) * rv.words + k] |= mask.rows[i * mask.words + k]
         return rv
 
-    def blit(self, tile, x, y):
-        for i in range(tile.h):
-            for j in range(tile.w):
-                self.set(x + i, y + j, tile.at(i, j))
+    def asLines(self):
+        canvas = blank(self.h, self.w)
+        board = self
+        while board is not None:
+            canvas.paint(board.tile, board.x, board.y)
+            board = board.parent
+        return canvas.asLines()
+
+def startBoard(tile):
+    return Board(tile.h, tile.w, tile.shifted(0).rows, None, tile, 0, 0)
 
 def blank(h, w): return Canvas(bytearray(" " * (w * h)), h, w)
 
@@ -139,7 +205,7 @@ def main(argv):
     for tile in tiles:
         print "Got tile: height", tile.h, "width", tile.w
         print tile.asLines()
-    boards = [tile for tile in tiles if tile.canStart()]
+    boards = [startBoard(tile) for tile in tiles if tile.canStart()]
     gen = 0
     while len(boards):
         gen += 1
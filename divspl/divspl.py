@@ -1,16 +1,24 @@
+import os
+import stat
 import sys
 
 from rpython.jit.codewriter.policy import JitPolicy
+from rpython.rlib import rposix
 from rpython.rlib.jit import JitDriver
 
 # This is a basic interpreter for DIVSPL, as described at
 # https://www.promptworks.com/blog/the-fastest-fizzbuzz-in-the-west
 # Version 0: Initial functionality
 # Version 1: Port to RPython, add JIT
+# Version 2: Buffered output
+# Version 3: Period tables, counters instead of modulo
+# Version 4: Decimal counter instead of str()
+# Version 5: Parallel rendering
 
 def parseAssignment(line):
     word, number = [w.strip() for w in line.rsplit("=", 1)]
-    return word, int(number)
+    # Only the divisor's magnitude matters.
+    return word, abs(int(number))
 
 def parse(lines):
     # The first line must be the range.
@@ -19,27 +27,264 @@ def parse(lines):
     assignments = [parseAssignment(line) for line in lines[1:] if line]
     return start, stop, assignments
 
+def writeAll(fd, s):
+    while s: s = s[os.write(fd, s):]
+
+class Output(object):
+    # One reusable buffer, written to fd in blocks of its size. With no fd,
+    # the blocks are kept until taken.
+    def __init__(self, size, fd):
+        self.buf = ["\x00"] * size
+        self.pos = 0
+        self.fd = fd
+        self.blocks = []
+    def emit(self, block):
+        if self.fd < 0: self.blocks.append(block)
+        else: writeAll(self.fd, block)
+    def write(self, s):
+        if self.pos + len(s) > len(self.buf):
+            self.flush()
+            if len(s) > len(self.buf):
+                self.emit(s)
+                return
+        for c in s:
+            self.buf[self.pos] = c
+            self.pos += 1
+    def writeChars(self, chars, start):
+        assert start >= 0
+        if self.pos + len(chars) - start > len(self.buf):
+            self.flush()
+            if len(chars) - start > len(self.buf):
+                self.emit("".join(chars[start:]))
+                return
+        for k in range(start, len(chars)):
+            self.buf[self.pos] = chars[k]
+            self.pos += 1
+    def flush(self):
+        if self.pos:
+            self.emit("".join(self.buf[:self.pos]))
+            self.pos = 0
+    def take(self):
+        self.flush()
+        data = "".join(self.blocks)
+        self.blocks = []
+        return data
+
+# The current number and a newline, right-aligned in a buffer wide enough
+# for any machine word. Counting up touches one digit on average.
+class Decimal(object):
+    def __init__(self, n):
+        self.chars = ["0"] * 21 + ["\n"]
+        self.start = len(self.chars) - 2
+        while n:
+            self.chars[self.start] = chr(ord("0") + n % 10)
+            n //= 10
+            if n: self.start -= 1
+    def increment(self):
+        k = len(self.chars) - 2
+        while k >= self.start and self.chars[k] == "9":
+            self.chars[k] = "0"
+            k -= 1
+        if k < self.start:
+            self.start = k
+            self.chars[k] = "1"
+        else: self.chars[k] = chr(ord(self.chars[k]) + 1)
+
+# Every line is decided by i modulo each divisor, so the output repeats
+# with the lcm of the divisors. Up to this period, precompute each line.
+PERIOD_LIMIT = 1 << 16
+
+def gcd(a, b):
+    while b: a, b = b, a % b
+    return a
+
+# A line per residue, or None where the number itself is printed.
+def periodTable(assignments):
+    period = 1
+    for _, n in assignments:
+        period = period // gcd(period, n) * n
+        if period > PERIOD_LIMIT: return None
+    table = [None] * period
+    for r in range(period):
+        s = [w for w, n in assignments if not r % n]
+        if s: table[r] = "".join(s) + "\n"
+    return table
+
 def location(stop, assignments):
     return "%d rules, stop at %d" % (len(assignments), stop)
-driver = JitDriver(greens=["stop", "assignments"], reds=["i"],
-                   get_printable_location=location)
+tabledriver = JitDriver(greens=["stop", "table"],
+                        reds=["i", "r", "decimal", "out"], is_recursive=True)
+countdriver = JitDriver(greens=["stop", "assignments"],
+                        reds=["i", "counters", "decimal", "out"],
+                        get_printable_location=location, is_recursive=True)
+
+# Negative numbers are rare enough to go through str().
+def writeNumber(out, i, decimal):
+    if i < 0:
+        out.write(str(i))
+        out.write("\n")
+    else: out.writeChars(decimal.chars, decimal.start)
+
+def runTable(start, stop, table, out):
+    i = start
+    r = start % len(table)
+    decimal = Decimal(max(start, 0))
+    while i <= stop:
+        tabledriver.jit_merge_point(stop=stop, table=table, i=i, r=r,
+                                    decimal=decimal, out=out)
+        line = table[r]
+        if line is None: writeNumber(out, i, decimal)
+        else: out.write(line)
+        i += 1
+        if i > 0: decimal.increment()
+        r += 1
+        if r == len(table): r = 0
 
-def run(start, stop, assignments):
+# Past the limit, count up to each divisor instead of dividing.
+def runCounting(start, stop, assignments, out):
     i = start
+    counters = [start % n for _, n in assignments]
+    decimal = Decimal(max(start, 0))
     while i <= stop:
-        driver.jit_merge_point(stop=stop, assignments=assignments, i=i)
-        s = [w for w, n in assignments if not i % n]
-        print ("".join(s) if s else str(i))
+        countdriver.jit_merge_point(stop=stop, assignments=assignments, i=i,
+                                    counters=counters, decimal=decimal,
+                                    out=out)
+        matched = False
+        for j in range(len(assignments)):
+            w, n = assignments[j]
+            if not counters[j]:
+                out.write(w)
+                matched = True
+            counters[j] += 1
+            if counters[j] == n: counters[j] = 0
+        if matched: out.write("\n")
+        else: writeNumber(out, i, decimal)
         i += 1
+        if i > 0: decimal.increment()
+
+def run(start, stop, assignments, out):
+    table = periodTable(assignments)
+    if table is None: runCounting(start, stop, assignments, out)
+    else: runTable(start, stop, table, out)
+
+# In parallel, the range is cut into slices of this many numbers, which are
+# dealt round-robin to the jobs. A job renders a slice in memory and reports
+# its size. Then, in order, either the slice is copied through the job's
+# pipe, or the job is told the slice's offset in stdout and writes it there.
+SLICE = 1 << 20
+SIZE_WIDTH = 20
+
+def packSize(n):
+    s = str(n)
+    return "0" * (SIZE_WIDTH - len(s)) + s
+
+def readExactly(fd, n):
+    pieces = []
+    while n:
+        piece = os.read(fd, min(n, 1 << 16))
+        if not piece: raise OSError(0, "worker failed")
+        pieces.append(piece)
+        n -= len(piece)
+    return "".join(pieces)
+
+def copyExactly(src, dst, n):
+    while n:
+        piece = os.read(src, min(n, 1 << 16))
+        if not piece: raise OSError(0, "worker failed")
+        writeAll(dst, piece)
+        n -= len(piece)
+
+def pwriteAll(fd, data, offset):
+    while data:
+        written = rposix.pwrite(fd, data, offset)
+        data = data[written:]
+        offset += written
+
+def renderSlices(start, stop, assignments, size, job, jobs, report, offsets):
+    k = job
+    while k <= (stop - start) // SLICE:
+        first = start + k * SLICE
+        out = Output(size, -1)
+        run(first, min(stop, first + SLICE - 1), assignments, out)
+        data = out.take()
+        writeAll(report, packSize(len(data)))
+        if offsets < 0: writeAll(report, data)
+        else: pwriteAll(1, data, int(readExactly(offsets, SIZE_WIDTH)))
+        k += jobs
+
+def forkRenderer(start, stop, assignments, size, job, jobs, toFile):
+    reportRead, reportWrite = os.pipe()
+    offsetRead = offsetWrite = -1
+    if toFile: offsetRead, offsetWrite = os.pipe()
+    pid = os.fork()
+    if not pid:
+        os.close(reportRead)
+        if toFile: os.close(offsetWrite)
+        renderSlices(start, stop, assignments, size, job, jobs, reportWrite,
+                     offsetRead)
+        os._exit(0)
+    os.close(reportWrite)
+    if toFile: os.close(offsetRead)
+    return pid, reportRead, offsetWrite
+
+# pwrite ignores offsets on files opened for appending.
+def isPlainFile(fd):
+    if not stat.S_ISREG(os.fstat(fd).st_mode): return False
+    return not rposix.get_status_flags(fd) & os.O_APPEND
+
+def runParallel(start, stop, assignments, size, jobs):
+    if stop < start: return
+    slices = (stop - start) // SLICE + 1
+    jobs = min(jobs, slices)
+    toFile = isPlainFile(1)
+    offset = os.lseek(1, 0, 1) if toFile else 0
+    workers = [forkRenderer(start, stop, assignments, size, job, jobs, toFile)
+               for job in range(jobs)]
+    for k in range(slices):
+        _, report, offsets = workers[k % jobs]
+        n = int(readExactly(report, SIZE_WIDTH))
+        if toFile: writeAll(offsets, packSize(offset))
+        else: copyExactly(report, 1, n)
+        offset += n
+    for pid, report, offsets in workers:
+        os.close(report)
+        if toFile: os.close(offsets)
+        _, status = os.waitpid(pid, 0)
+        if not os.WIFEXITED(status) or os.WEXITSTATUS(status):
+            raise OSError(0, "worker failed")
+    if toFile: os.lseek(1, offset, 0)
 
 # NB: programs should already be split into lines
 def main(argv):
-    if len(argv) != 2:
-        print "Usage: divspl program.divspl"
+    size = 1 << 16
+    jobs = 1
+    args = []
+    i = 1
+    while i < len(argv):
+        if argv[i] == "-b" and i + 1 < len(argv):
+            size = int(argv[i + 1])
+            i += 2
+        elif argv[i] == "-j" and i + 1 < len(argv):
+            jobs = int(argv[i + 1])
+            i += 2
+        else:
+            args.append(argv[i])
+            i += 1
+    if len(args) != 1 or size < 1 or jobs < 1:
+        print "Usage: divspl [-b <output buffer size>] [-j <jobs>] program.divspl"
         return 1
-    with open(argv[1]) as handle: program = handle.read().split("\n")
+    with open(args[0]) as handle: program = handle.read().split("\n")
     start, stop, assignments = parse(program)
-    run(start, stop, assignments)
+    for _, n in assignments:
+        if not n:
+            print "Divisors must be nonzero"
+            return 1
+    if jobs > 1:
+        runParallel(start, stop, assignments, size, jobs)
+        return 0
+    out = Output(size, 1)
+    try: run(start, stop, assignments, out)
+    finally: out.flush()
     return 0
 
 def target(*args): return main, None
@@ -246,6 +246,17 @@
 
           src = ./1brc;
         };
+        r1brc-create = mkRPythonDerivation {
+          entrypoint = "create.py";
+          binName = "create-c";
+          binInstallName = "1brc-create";
+          optLevel = "2";
+        } {
+          pname = "1brc-create";
+          version = "1";
+
+          src = ./1brc;
+        };
         biia = mkRPythonDerivation {
           entrypoint = "biia.py";
           binName = "biia-c";
@@ -650,8 +661,8 @@
         };
         lib = { inherit mkRPythonDerivation; };
         packages = rec {
-          inherit r1brc biia bf dcpu16py divspl hippyvm icbink pixie plang
-            pycket pydgin pypy2 pypy3 pyrolog rsqueak topaz;
+          inherit r1brc r1brc-create biia bf dcpu16py divspl hippyvm icbink
+            pixie plang pycket pydgin pypy2 pypy3 pyrolog rsqueak topaz;
           inherit bfStatic;
           inherit pydrofoil-arm pydrofoil-cheriot pydrofoil-riscv;
           inherit pysom-ast pysom-bc;
@@ -664,6 +675,8 @@
           packages = builtins.filter (p: !p.meta.broken) (with pkgs; [
             cachix nix-tree
             patchutils
+            # For bench/bench.py.
+            python3
             # pypy2Minimal
             # linuxPackages.perf gdb
           ]);